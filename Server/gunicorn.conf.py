@@ -0,0 +1,17 @@
+import multiprocessing
+import os
+
+# Production launcher: gunicorn -c gunicorn.conf.py main:app
+# Runs one Uvicorn worker (event loop) per CPU core
+# uvicorn[standard] makes the workers use uvloop and httptools automatically
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
+workers = int(os.getenv("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+
+# Let the app see the real worker count (db.py splits the Mongo pool between workers)
+os.environ["WEB_CONCURRENCY"] = str(workers)
+worker_class = "uvicorn.workers.UvicornWorker"
+
+# Import the app once in the master before forking the workers
+# (the Mongo client is created lazily, so every worker still opens its own)
+preload_app = True
@@ -1,5 +1,41 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
+from fastapi.encoders import jsonable_encoder
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import ORJSONResponse
+from src.db import get_db
+from src import history_buffer
 from src.routes import router
 
-app = FastAPI(title="Stocks Course Project API")
+# orjson serializes large payloads (e.g. history points) much faster than stdlib json
+app = FastAPI(title="Stocks Course Project API", default_response_class=ORJSONResponse)
 app.include_router(router)
+
+
+# Validation errors echo the rejected input, which can be NaN/inf (e.g. a history
+# price); stdlib json refuses those, so the 422 is rendered with orjson (NaN -> null)
+@app.exception_handler(RequestValidationError)
+async def validation_error_handler(request: Request, exc: RequestValidationError):
+    return ORJSONResponse(status_code=422, content={"detail": jsonable_encoder(exc.errors())})
+
+
+# Creates the indexes used by the hot lookups (auth, quotes, history, watchlists)
+# create_index is a no-op if the index already exists
+@app.on_event("startup")
+async def create_indexes():
+    db = get_db()
+    await db["users"].create_index("email", unique=True)
+    await db["stocks"].create_index("symbol", unique=True)
+    await db["stock_history"].create_index("symbol", unique=True)
+    await db["watchlists"].create_index("userId", unique=True)
+
+
+# Starts the background task that batches history appends
+@app.on_event("startup")
+async def start_history_buffer():
+    history_buffer.start()
+
+
+# Writes any history points still waiting in the buffer
+@app.on_event("shutdown")
+async def stop_history_buffer():
+    await history_buffer.stop()
@@ -0,0 +1,22 @@
+import asyncio
+from src.db import get_db
+from src import history_store
+
+
+# One-off migration of stock history documents to the column layout
+# Run once after deploying, from the Server folder:
+#   python migrate_history.py
+# Repeats passes while documents changed during a pass (they are re-read and
+# merged again by the next one)
+async def main():
+    collection = get_db()["stock_history"]
+    total = 0
+    changed = True
+    while changed:
+        converted, skipped, changed = await history_store.migrate_legacy(collection)
+        total += converted
+    print(f"converted {total} history documents, skipped {skipped} that did not round-trip")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,33 +1,38 @@
 import os
-from pymongo import MongoClient
+from functools import lru_cache
+from pymongo import AsyncMongoClient
 from dotenv import load_dotenv
 
 # Load environment variables (like MONGO_URI) from the .env file
 load_dotenv()
 
-# Global variable to store the active MongoDB connection
-# We use this to ensure we connect only once (Singleton pattern)
-_client = None
+# Read the connection string and database name once, at import time
+MONGO_URI = os.getenv("MONGO_URI")
+DB_NAME = os.getenv("DB_NAME", "stockdb")
 
+# Safety check: ensure the URI exists
+if not MONGO_URI:
+    raise RuntimeError("MONGO_URI missing in .env")
 
-# Establishes or retrieves the connection to the MongoDB database
-# 1. Reads the URI from environment variables
-# 2. Connects to the cloud database
-# 3. Returns the specific database object
-def get_db():
-    global _client
-
-    # Get the connection string and database name from .env
-    uri = os.getenv("MONGO_URI")
-    db_name = os.getenv("DB_NAME", "stockdb")
+# Connection pool size per process
+# Each server worker has its own pool, so by default a total budget of
+# MONGO_MAX_CONNECTIONS is split between the WEB_CONCURRENCY workers
+# MONGO_MAX_POOL_SIZE overrides the per-process size directly
+WORKERS = int(os.getenv("WEB_CONCURRENCY", "1"))
+MONGO_MAX_CONNECTIONS = int(os.getenv("MONGO_MAX_CONNECTIONS", "100"))
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", max(1, MONGO_MAX_CONNECTIONS // WORKERS)))
 
-    # Safety check: ensure the URI exists
-    if not uri:
-        raise RuntimeError("MONGO_URI missing in .env")
 
-    # Connect only if a connection doesn't exist yet (Lazy Loading)
-    if _client is None:
-        _client = MongoClient(uri)
+# Establishes or retrieves the connection to the MongoDB database
+# 1. Connects to the cloud database
+# 2. Returns the specific database object
+# The result is memoized, so the client (and its connection pool) is created
+# only once per process (Singleton pattern)
+@lru_cache(maxsize=1)
+def get_db():
+    # PyMongo's async client lets the routes await Mongo I/O on the event loop
+    # No minPoolSize: idle workers don't hold connections open
+    client = AsyncMongoClient(MONGO_URI, maxPoolSize=MONGO_MAX_POOL_SIZE)
 
     # Return the specific database object
-    return _client[db_name]
+    return client[DB_NAME]
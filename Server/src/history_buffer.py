@@ -0,0 +1,202 @@
+import asyncio
+import logging
+import time
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, ConnectionFailure, PyMongoError
+from .db import get_db
+from . import history_store
+
+# Coalesces single-point history appends in memory and writes them to MongoDB
+# in batches (one bulk_write per flush instead of one update per point)
+
+# Flush at least this often (seconds)
+FLUSH_INTERVAL = 0.05
+# Flush early once this many points are waiting
+MAX_PENDING = 1000
+# Reject new points once this many are waiting (e.g. while MongoDB is unreachable)
+MAX_BUFFERED = 100_000
+# Retry delay after a failed flush doubles up to this cap (seconds)
+MAX_BACKOFF = 5.0
+# A symbol's points are dropped after this many failed (transient) write attempts
+MAX_RETRIES = 20
+
+# MongoDB error code for a duplicate key (e.g. two concurrent upserts of a new symbol)
+DUPLICATE_KEY = 11000
+
+log = logging.getLogger(__name__)
+
+# Points waiting to be written, grouped by symbol
+_pending: dict[str, list[dict]] = {}
+_pending_count = 0
+_flush_now = asyncio.Event()
+_task: asyncio.Task | None = None
+_stopping = False
+# Failed write attempts per symbol, reset once the symbol is written
+_attempts: dict[str, int] = {}
+
+
+# Queues a point for the next flush and returns immediately
+# Returns False (point not queued) when the buffer is full
+def queue_point(symbol: str, point: dict) -> bool:
+    global _pending_count
+    if _pending_count >= MAX_BUFFERED:
+        return False
+
+    _pending.setdefault(symbol, []).append(point)
+    _pending_count += 1
+    if _pending_count >= MAX_PENDING:
+        _flush_now.set()
+    return True
+
+
+# Puts points from a failed flush back in front of the newer queued points
+def _requeue(batch: dict[str, list[dict]]):
+    global _pending_count
+    for symbol, points in batch.items():
+        _pending[symbol] = points + _pending.get(symbol, [])
+        _pending_count += len(points)
+
+
+# Re-queues points after a transient failure, at most MAX_RETRIES times per symbol
+# Returns the number of points queued again
+def _retry(batch: dict[str, list[dict]]) -> int:
+    retry = {}
+    for symbol, points in batch.items():
+        attempts = _attempts.get(symbol, 0) + 1
+        if attempts > MAX_RETRIES:
+            log.error("dropping %d history points for %s after %d failed writes", len(points), symbol, MAX_RETRIES)
+            _attempts.pop(symbol, None)
+            continue
+        _attempts[symbol] = attempts
+        retry[symbol] = points
+
+    _requeue(retry)
+    return sum(len(points) for points in retry.values())
+
+
+# Errors worth retrying: lost connections / timeouts and writes the server marks retryable
+def _is_transient(error: Exception) -> bool:
+    if isinstance(error, ConnectionFailure):
+        return True
+    return isinstance(error, PyMongoError) and error.has_error_label("RetryableWriteError")
+
+
+# Builds the append update for one symbol, dropping (and logging) points that can't be stored
+def _build_op(symbol: str, points: list[dict], now: int) -> UpdateOne | None:
+    valid = [p for p in points if history_store.is_encodable(p)]
+    if len(valid) < len(points):
+        log.error("dropping %d history points for %s that can't be stored", len(points) - len(valid), symbol)
+    if not valid:
+        return None
+    return UpdateOne({"symbol": symbol}, history_store.append_update(valid, now), upsert=True)
+
+
+# Writes all queued points with a single unordered bulk_write
+# Each batch is merged into the stored columns in timestamp order
+# Failures are handled per symbol: transient ones are queued again (see _retry),
+# permanent ones (bad points, documents MongoDB rejects) are dropped and logged
+# Returns the number of points queued again for a retry
+async def flush() -> int:
+    global _pending, _pending_count
+    if not _pending:
+        return 0
+
+    batch, _pending, _pending_count = _pending, {}, 0
+    now = int(time.time())
+
+    symbols, ops = [], []
+    for symbol, points in batch.items():
+        try:
+            op = _build_op(symbol, points, now)
+        except Exception:
+            log.exception("dropping %d history points for %s", len(points), symbol)
+            op = None
+        if op is None:
+            _attempts.pop(symbol, None)
+            continue
+        symbols.append(symbol)
+        ops.append(op)
+
+    if not ops:
+        return 0
+
+    try:
+        await get_db()["stock_history"].bulk_write(ops, ordered=False)
+    except BulkWriteError as e:
+        # Unordered: the other symbols were written, only the failed ones are handled
+        failed = {}
+        for err in e.details.get("writeErrors", []):
+            symbol = symbols[err["index"]]
+            if err.get("code") == DUPLICATE_KEY:
+                failed[symbol] = batch[symbol]
+            else:
+                log.error("dropping %d history points for %s: %s", len(batch[symbol]), symbol, err.get("errmsg"))
+                _attempts.pop(symbol, None)
+        for symbol in symbols:
+            if symbol not in failed:
+                _attempts.pop(symbol, None)
+        return _retry(failed)
+    except Exception as e:
+        if _is_transient(e):
+            log.warning("history flush failed (%s), will retry", e)
+            return _retry({symbol: batch[symbol] for symbol in symbols})
+        log.exception("dropping %d history points after a failed write", sum(len(batch[s]) for s in symbols))
+        for symbol in symbols:
+            _attempts.pop(symbol, None)
+        return 0
+
+    for symbol in symbols:
+        _attempts.pop(symbol, None)
+    return 0
+
+
+# Background loop: flushes every FLUSH_INTERVAL, or sooner when MAX_PENDING is reached
+# After a failure it waits with exponential backoff (up to MAX_BACKOFF) before retrying
+async def _run():
+    delay = FLUSH_INTERVAL
+    while not _stopping:
+        if delay > FLUSH_INTERVAL:
+            await asyncio.sleep(delay)
+        else:
+            try:
+                await asyncio.wait_for(_flush_now.wait(), timeout=FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+        _flush_now.clear()
+
+        try:
+            retried = await flush()
+        except Exception:
+            log.exception("failed to flush history points")
+            retried = 1
+        delay = min(delay * 2, MAX_BACKOFF) if retried else FLUSH_INTERVAL
+
+
+# Starts the background flusher (called on app startup)
+# Resets the stop flag and the wake-up event (which is bound to the event loop it
+# was first awaited on), so the buffer works again after a shutdown/startup cycle
+def start():
+    global _task, _stopping, _flush_now
+    if _task is None:
+        _stopping = False
+        _flush_now = asyncio.Event()
+        _task = asyncio.create_task(_run())
+
+
+# Stops the flusher and writes whatever is still queued (called on app shutdown)
+# The loop is asked to exit instead of being cancelled, so a flush that is
+# already inside bulk_write finishes (or re-queues its batch) first
+async def stop():
+    global _task, _stopping
+    if _task is not None:
+        _stopping = True
+        _flush_now.set()
+        await _task
+        _task = None
+
+    try:
+        await flush()
+    except Exception:
+        log.exception("failed to flush history points on shutdown")
+    if _pending_count:
+        log.error("%d history points could not be written before shutdown", _pending_count)
@@ -0,0 +1,226 @@
+import math
+from pymongo import UpdateOne
+
+# Storage layout for stock history documents
+# Points are stored column-wise (Struct-of-Arrays) and compacted:
+#   {"symbol": "AAPL", "base_ts": 1700000000,
+#    "ts_delta": [0, 60, ...], "price_units": [189120000, 189200000, ...], "volume": [...],
+#    "updatedAt": ..., "version": ...}
+# - timestamps are offsets from 'base_ts' (the first point's timestamp)
+# - prices are scaled integers (millionths, so 4-6 significant digits survive
+#   even for sub-dollar symbols)
+# - 'version' is incremented on every write (used for the history ETag)
+# Small integers are encoded by BSON as int32 (larger ones fall back to int64),
+# so this roughly halves the bytes stored and sent per point compared to
+# int64/double values
+
+# Prices are stored as integer multiples of 1/PRICE_SCALE
+PRICE_SCALE = 1_000_000
+
+# Largest values BSON can store as an integer (int64)
+# Prices below MAX_PRICE always fit once scaled; timestamps and volumes are kept
+# non-negative so timestamp deltas fit as well
+INT64_MAX = 2**63 - 1
+MAX_PRICE = INT64_MAX // PRICE_SCALE
+
+
+def _to_price_units(price: float) -> int:
+    return int(round(price * PRICE_SCALE))
+
+
+# Checks that a point can be encoded in the integer columns
+# (the API already validates this; the history buffer re-checks before writing)
+def is_encodable(point: dict) -> bool:
+    price = point.get("price")
+    if isinstance(price, bool) or not isinstance(price, (int, float)):
+        return False
+    if not (math.isfinite(price) and 0 <= price < MAX_PRICE):
+        return False
+    return all(
+        isinstance(point.get(field), int) and 0 <= point[field] <= INT64_MAX
+        for field in ("ts", "volume")
+    )
+
+
+# Converts a list of point dicts ({ts, price, volume}) into the stored columns
+# 'points' must be sorted by timestamp
+# An empty list leaves 'base_ts' out, so an existing base is kept for later appends
+def to_columns(points: list[dict]) -> dict:
+    columns = {
+        "ts_delta": [],
+        "price_units": [_to_price_units(p["price"]) for p in points],
+        "volume": [p["volume"] for p in points]
+    }
+    if points:
+        base_ts = points[0]["ts"]
+        columns["base_ts"] = base_ts
+        columns["ts_delta"] = [p["ts"] - base_ts for p in points]
+    return columns
+
+
+# Lazily rebuilds the point dicts from a stored history document
+# The stored columns are always ordered by timestamp (see append_update)
+# A document not migrated yet still has the old "points" list; it is merged with
+# any columns written since, and only the latest 'limit' points are kept
+def iter_points(doc: dict, limit: int | None = None):
+    base_ts = doc.get("base_ts", 0)
+    rows = zip(doc.get("ts_delta", []), doc.get("price_units", []), doc.get("volume", []))
+    points = (
+        {"ts": base_ts + delta, "price": units / PRICE_SCALE, "volume": volume}
+        for delta, units, volume in rows
+    )
+
+    legacy = doc.get("points")
+    if not legacy:
+        yield from points
+        return
+
+    merged = sorted(
+        [{"ts": p["ts"], "price": p["price"], "volume": p["volume"]} for p in legacy] + list(points),
+        key=lambda p: p["ts"]
+    )
+    yield from (merged if limit is None else merged[-limit:])
+
+
+# MongoDB projection that fetches only the latest 'limit' points
+def tail_projection(limit: int) -> dict:
+    return {
+        "_id": 0,
+        "symbol": 1,
+        "updatedAt": 1,
+        "version": 1,
+        "base_ts": 1,
+        "ts_delta": {"$slice": -limit},
+        "price_units": {"$slice": -limit},
+        "volume": {"$slice": -limit},
+        "points": {"$slice": -limit}
+    }
+
+
+# Update pipeline that merges points into the columns, keeping them ordered by timestamp
+# Runs as a single update so the deltas are always computed against the
+# document's current 'base_ts' (set from the first point on insert)
+# - fast path: the batch starts at or after the last stored point -> plain append
+# - otherwise (late/backfilled points, batches from different workers) the
+#   columns are zipped into rows, sorted by timestamp and unzipped again
+def append_update(points: list[dict], updated_at: int) -> list[dict]:
+    points = sorted(points, key=lambda p: p["ts"])
+    rows = [[p["ts"], _to_price_units(p["price"]), p["volume"]] for p in points]
+
+    # Keep deltas as int32 when they fit (falls back to int64 on overflow)
+    delta = {"$subtract": [{"$arrayElemAt": ["$$this", 0]}, "$base_ts"]}
+    as_int32 = {"$convert": {"input": delta, "to": "int", "onError": delta}}
+
+    def stored(col):
+        return {"$ifNull": [f"${col}", []]}
+
+    def column(rows_expr, i):
+        return {"$map": {"input": rows_expr, "in": {"$arrayElemAt": ["$$this", i]}}}
+
+    def merged(col, i):
+        return {"$cond": [
+            "$_in_order",
+            {"$concatArrays": [stored(col), column("$_new", i)]},
+            column("$_rows", i)
+        ]}
+
+    return [
+        {"$set": {"base_ts": {"$ifNull": ["$base_ts", points[0]["ts"]]}}},
+        # New rows as [ts_delta, price_units, volume]
+        {"$set": {"_new": {"$map": {
+            "input": {"$literal": rows},
+            "in": [as_int32, {"$arrayElemAt": ["$$this", 1]}, {"$arrayElemAt": ["$$this", 2]}]
+        }}}},
+        {"$set": {"_in_order": {"$gte": [
+            {"$arrayElemAt": [{"$arrayElemAt": ["$_new", 0]}, 0]},
+            {"$ifNull": [{"$last": stored("ts_delta")}, None]}
+        ]}}},
+        {"$set": {"_rows": {"$cond": [
+            "$_in_order",
+            None,
+            {"$sortArray": {
+                "input": {"$concatArrays": [
+                    {"$zip": {"inputs": [stored("ts_delta"), stored("price_units"), stored("volume")]}},
+                    "$_new"
+                ]},
+                "sortBy": 1
+            }}
+        ]}}},
+        {"$set": {
+            "ts_delta": merged("ts_delta", 0),
+            "price_units": merged("price_units", 1),
+            "volume": merged("volume", 2),
+            "updatedAt": updated_at,
+            "version": {"$add": [{"$ifNull": ["$version", 0]}, 1]}
+        }},
+        {"$unset": ["_new", "_in_order", "_rows"]}
+    ]
+
+
+# Number of documents converted per bulk_write during the migration
+MIGRATE_BATCH_SIZE = 100
+
+
+# Checks that a list of points survives encoding + decoding
+# (timestamps and volumes exactly, prices within the rounding step)
+def round_trips(points: list[dict]) -> bool:
+    decoded = list(iter_points(to_columns(points)))
+    return len(decoded) == len(points) and all(
+        a["ts"] == b["ts"]
+        and a["volume"] == b["volume"]
+        and abs(a["price"] - b["price"]) <= 0.5 / PRICE_SCALE
+        for a, b in zip(points, decoded)
+    )
+
+
+# Builds the update converting one legacy document, or None if its points
+# don't round-trip through the new encoding
+# The legacy points are merged with any columns written since the upgrade, and
+# the update only matches while 'points' exists and 'version' is unchanged, so a
+# write that lands between reading and converting the document is never lost
+def _migration_op(doc: dict) -> UpdateOne | None:
+    legacy = sorted(doc["points"], key=lambda p: p.get("ts", 0))
+    if not round_trips(legacy):
+        return None
+
+    merged = list(iter_points(doc))
+    version = doc.get("version")
+    return UpdateOne(
+        {"_id": doc["_id"], "points": {"$exists": True}, "version": version},
+        {
+            "$set": {**to_columns(merged), "version": (version or 0) + 1},
+            "$rename": {"points": "legacy_points"}
+        }
+    )
+
+
+# One-off upgrade of documents written with the old layout:
+#   "points": [{ts, price, volume}, ...]
+# Run through migrate_history.py; returns (converted, skipped, changed) document counts
+# - the original array is kept as 'legacy_points' (drop it once the new data is checked)
+# - documents whose points don't round-trip through the new encoding are skipped
+# - 'changed' counts documents written to while being converted; they are
+#   left for the next pass
+async def migrate_legacy(collection) -> tuple[int, int, int]:
+    converted = skipped = attempted = 0
+    ops = []
+
+    async def write(batch):
+        return (await collection.bulk_write(batch, ordered=False)).matched_count
+
+    async for doc in collection.find({"points": {"$exists": True}}):
+        op = _migration_op(doc)
+        if op is None:
+            skipped += 1
+            continue
+        ops.append(op)
+
+        if len(ops) >= MIGRATE_BATCH_SIZE:
+            attempted += len(ops)
+            converted += await write(ops)
+            ops = []
+
+    if ops:
+        attempted += len(ops)
+        converted += await write(ops)
+    return converted, skipped, attempted - converted
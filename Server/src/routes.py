@@ -1,17 +1,53 @@
 import os
 import time
-from fastapi import APIRouter, HTTPException, Depends
+import hashlib
+import threading
+from itertools import islice
+import orjson
+import anyio
+from functools import lru_cache
+from cachetools import TTLCache
+from fastapi import APIRouter, HTTPException, Depends, Query, Request, Response
+from fastapi.responses import StreamingResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from pydantic import BaseModel
-from passlib.hash import bcrypt
+from pydantic import BaseModel, Field, TypeAdapter
+from pymongo import UpdateOne
+from pymongo.errors import DuplicateKeyError
+from passlib.context import CryptContext
 import jwt
-from dotenv import load_dotenv
 from .db import get_db
+from . import history_buffer, history_store
 
-# Load environment variables (DB URI, Secrets) from the .env file
-load_dotenv()
+# Environment variables (DB URI, Secrets) are loaded from the .env file by db.py
 JWT_SECRET = os.getenv("JWT_SECRET", "change_me")
 
+# Password hashing: Argon2id with the OWASP parameters (m=46 MiB, t=1, p=1)
+# bcrypt is still accepted for existing users and is re-hashed on their next login
+pwd_context = CryptContext(
+    schemes=["argon2", "bcrypt"],
+    deprecated=["bcrypt"],
+    argon2__type="id",
+    argon2__memory_cost=47104,
+    argon2__rounds=1,
+    argon2__parallelism=1
+)
+
+# Each Argon2 hash allocates ~46 MiB, so only HASH_CONCURRENCY hashes/verifications
+# run at once per worker (the rest wait); keeps memory at ~46 MiB x HASH_CONCURRENCY
+HASH_CONCURRENCY = int(os.getenv("HASH_CONCURRENCY", "4"))
+_hash_limiter: anyio.CapacityLimiter | None = None
+
+# Cache of already-verified tokens: token -> (uid, exp)
+# Skips the HMAC check + JSON parse on repeated requests with the same token
+# require_user runs in the threadpool, so access is guarded by a lock
+_token_cache = TTLCache(maxsize=10000, ttl=60)
+_token_cache_lock = threading.Lock()
+
+# Short-lived cache of /quote responses: symbol -> response dict
+# MongoDB stays the source of truth; this only absorbs bursts of repeated quotes
+# Each worker has its own copy, so other workers may serve a quote up to 'ttl' seconds old
+_quote_cache = TTLCache(maxsize=2048, ttl=2.0)
+
 router = APIRouter()
 
 # Security scheme: Extract the Bearer token from the Authorization header
@@ -37,23 +73,35 @@ class StockUpsertBody(BaseModel):
     price: float | None = None
     currency: str = "USD"
 
+# Model for seeding many stocks in a single request
+class BulkSeedBody(BaseModel):
+    items: list[StockUpsertBody]
+
 # Represents a single data point (timestamp, price, volume) in the chart history
+# Bounded to what the integer storage encoding can hold (see history_store);
+# anything else (NaN, inf, negative, out of range) is rejected with 422
 class HistoryPoint(BaseModel):
-    ts: int          
-    price: float
-    volume: int
+    ts: int = Field(ge=0, le=history_store.INT64_MAX)
+    price: float = Field(ge=0, lt=history_store.MAX_PRICE, allow_inf_nan=False)
+    volume: int = Field(ge=0, le=history_store.INT64_MAX)
 
 # Model for uploading a complete history list for a specific stock
 class StockHistoryBody(BaseModel):
     symbol: str
     points: list[HistoryPoint]
 
+# Serializes a whole list of points in one pydantic-core call
+# (instead of calling model_dump() on every point)
+_points_adapter = TypeAdapter(list[HistoryPoint])
+
 
 
 # ============== Helper Functions ==============
 
 # Generates a JWT token for the authenticated user
 # Token is valid for 7 days
+# PyJWT signs HS256 with the stdlib hmac/hashlib (C code); repeated verification
+# is skipped entirely by the token cache in require_user
 def create_token(user_id: str) -> str:
     payload = {"uid": user_id, "exp": int(time.time()) + 60 * 60 * 24 * 7}
     return jwt.encode(payload, JWT_SECRET, algorithm="HS256")
@@ -61,36 +109,79 @@ def create_token(user_id: str) -> str:
 # Dependency to protect routes
 # Validates the JWT token and returns the User ID (uid)
 # Raises 401 if the token is invalid or expired
+# Verified tokens are cached briefly; a cache hit only re-checks the expiry
 def require_user(creds: HTTPAuthorizationCredentials = Depends(bearer)) -> str:
     token = creds.credentials
+
+    with _token_cache_lock:
+        cached = _token_cache.get(token)
+    if cached is not None:
+        uid, exp = cached
+        if exp > time.time():
+            return uid
+
     try:
-        payload = jwt.decode(token, JWT_SECRET, algorithms=["HS256"])
-        return payload["uid"]
+        payload = jwt.decode(
+            token, JWT_SECRET, algorithms=["HS256"], options={"require": ["exp", "uid"]}
+        )
+        uid, exp = payload["uid"], payload["exp"]
     except Exception:
         raise HTTPException(status_code=401, detail="invalid token")
 
+    with _token_cache_lock:
+        _token_cache[token] = (uid, exp)
+    return uid
+
+# Runs a password hash/verify call in a worker thread, bounded by HASH_CONCURRENCY
+# (the limiter is created lazily because it must belong to the running event loop)
+async def run_password_hashing(func, *args):
+    global _hash_limiter
+    if _hash_limiter is None:
+        _hash_limiter = anyio.CapacityLimiter(HASH_CONCURRENCY)
+    return await anyio.to_thread.run_sync(func, *args, limiter=_hash_limiter)
+
+# Memoized upper/strip for symbols seen on hot paths (quote, history, watchlist)
+@lru_cache(maxsize=4096)
+def _norm(symbol: str) -> str:
+    return symbol.upper().strip()
+
 # Standardizes stock symbols (e.g., converts ' nike ' to 'NIKE')
 # Ensures consistency across the database
 def norm_symbol(symbol: str) -> str:
-    s = (symbol or "").upper().strip()
+    s = _norm(symbol or "")
     if not s:
         raise HTTPException(status_code=400, detail="symbol required")
     return s
 
+# Builds a short, quoted ETag from the given parts (e.g. symbol + version)
+def make_etag(*parts) -> str:
+    key = ":".join(str(p) for p in parts).encode()
+    return '"' + hashlib.blake2b(key, digest_size=8).hexdigest() + '"'
+
+# Checks the client's If-None-Match header against the current ETag
+# True means the client's cached copy is still valid (respond with 304)
+def etag_matches(request: Request, etag: str) -> bool:
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    return any(tag.strip().removeprefix("W/") == etag for tag in header.split(","))
+
 
 # ============== Routes ==============
 
 # Simple health check to verify the server is running
 @router.get("/health")
-def health():
+async def health():
     return {"status": "ok"}
 
 # Registers a new user
-# 1. Verifies email uniqueness
-# 2. Hashes the password using bcrypt
+# 1. Verifies email uniqueness (enforced by the unique index on users.email)
+# 2. Hashes the password using Argon2id (in a worker thread so the event loop isn't blocked)
 # 3. Initializes an empty watchlist for the user
 @router.post("/auth/register")
-def register(body: AuthBody):
+async def register(body: AuthBody):
     db = get_db()
     users = db["users"]
 
@@ -98,42 +189,46 @@ def register(body: AuthBody):
     if not email or not body.password:
         raise HTTPException(status_code=400, detail="email/password required")
 
-    if users.find_one({"email": email}):
+    hashed = await run_password_hashing(pwd_context.hash, body.password)
+    try:
+        res = await users.insert_one({"email": email, "password": hashed, "createdAt": int(time.time())})
+    except DuplicateKeyError:
         raise HTTPException(status_code=409, detail="email exists")
-
-    hashed = bcrypt.hash(body.password)
-    res = users.insert_one({"email": email, "password": hashed, "createdAt": int(time.time())})
     uid = str(res.inserted_id)
 
-    db["watchlists"].insert_one({"userId": uid, "symbols": []})
+    await db["watchlists"].insert_one({"userId": uid, "symbols": []})
 
     return {"token": create_token(uid)}
 
 # Authenticates a user
 # Checks email existence and verifies password hash
+# Old bcrypt hashes are upgraded to Argon2id once the password is verified
 # Returns a JWT access token
 @router.post("/auth/login")
-def login(body: AuthBody):
+async def login(body: AuthBody):
     db = get_db()
     users = db["users"]
 
     email = body.email.strip().lower()
-    u = users.find_one({"email": email})
-    if not u or not bcrypt.verify(body.password, u["password"]):
+    u = await users.find_one({"email": email})
+    if not u:
         raise HTTPException(status_code=401, detail="invalid credentials")
 
+    ok, new_hash = await run_password_hashing(pwd_context.verify_and_update, body.password, u["password"])
+    if not ok:
+        raise HTTPException(status_code=401, detail="invalid credentials")
+
+    if new_hash:
+        await users.update_one({"_id": u["_id"]}, {"$set": {"password": new_hash}})
+
     return {"token": create_token(str(u["_id"]))}
 
 
 # ============== Stocks Management ==============
 
-# Admin endpoint to create or update stock details
-# Uses 'upsert=True' to handle both creation and updates in one request
-@router.post("/stocks/seed")
-def upsert_stock(body: StockUpsertBody, uid: str = Depends(require_user)):
-    db = get_db()
-    symbol = norm_symbol(body.symbol)
-
+# Builds the '$set' document for creating or updating a stock
+# 'price' is only written when provided, so existing prices are kept
+def stock_update_doc(body: StockUpsertBody, symbol: str) -> dict:
     update_doc = {
         "symbol": symbol,
         "name": body.name,
@@ -144,32 +239,83 @@ def upsert_stock(body: StockUpsertBody, uid: str = Depends(require_user)):
     if body.price is not None:
         update_doc["price"] = body.price
 
-    db["stocks"].update_one(
+    return update_doc
+
+# Admin endpoint to create or update stock details
+# Uses 'upsert=True' to handle both creation and updates in one request
+# Bumps the stocks list version so cached copies of /stocks are invalidated
+@router.post("/stocks/seed")
+async def upsert_stock(body: StockUpsertBody, uid: str = Depends(require_user)):
+    db = get_db()
+    symbol = norm_symbol(body.symbol)
+
+    await db["stocks"].update_one(
         {"symbol": symbol},
-        {"$set": update_doc},
+        {"$set": stock_update_doc(body, symbol)},
         upsert=True
     )
+    await bump_stocks_version(db)
+    _quote_cache.pop(symbol, None)
 
     return {"ok": True, "symbol": symbol}
 
+# Admin endpoint to create or update many stocks at once
+# All upserts are sent in one unordered bulk_write (a single round-trip)
+# If a symbol appears more than once, the last item wins
+@router.post("/stocks/seed_bulk")
+async def upsert_stocks_bulk(body: BulkSeedBody, uid: str = Depends(require_user)):
+    db = get_db()
+
+    by_symbol = {norm_symbol(item.symbol): item for item in body.items}
+    if by_symbol:
+        ops = [
+            UpdateOne({"symbol": symbol}, {"$set": stock_update_doc(item, symbol)}, upsert=True)
+            for symbol, item in by_symbol.items()
+        ]
+        await db["stocks"].bulk_write(ops, ordered=False)
+        await bump_stocks_version(db)
+        for symbol in by_symbol:
+            _quote_cache.pop(symbol, None)
+
+    return {"ok": True, "count": len(by_symbol)}
+
+# Increments the version counter of the stocks collection (stored in 'meta')
+# Must be called after every write to 'stocks'
+async def bump_stocks_version(db):
+    await db["meta"].update_one({"_id": "stocks"}, {"$inc": {"version": 1}}, upsert=True)
+
 # Returns a list of all available stocks, sorted by symbol
+# Supports conditional GET: the ETag is derived from the stocks version counter,
+# so an unchanged list is answered with 304 without reading the collection
 @router.get("/stocks")
-def list_stocks(uid: str = Depends(require_user)):
+async def list_stocks(request: Request, response: Response, uid: str = Depends(require_user)):
     db = get_db()
-    items = list(db["stocks"].find({}, {"_id": 0}).sort("symbol", 1))
+
+    meta = await db["meta"].find_one({"_id": "stocks"}) or {}
+    etag = make_etag("stocks", meta.get("version", 0))
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+
+    items = await db["stocks"].find({}, {"_id": 0}).sort("symbol", 1).to_list(length=None)
+    response.headers["ETag"] = etag
     return {"items": items}
 
 # Fetches the current price and details for a specific stock
+# Served from the in-process quote cache when possible (read-through)
 @router.get("/stocks/{symbol}/quote")
-def quote(symbol: str, uid: str = Depends(require_user)):
-    db = get_db()
+async def quote(symbol: str, uid: str = Depends(require_user)):
     symbol = norm_symbol(symbol)
 
-    doc = db["stocks"].find_one({"symbol": symbol}, {"_id": 0})
+    cached = _quote_cache.get(symbol)
+    if cached is not None:
+        return cached
+
+    db = get_db()
+    doc = await db["stocks"].find_one({"symbol": symbol}, {"_id": 0})
     if not doc:
         raise HTTPException(status_code=404, detail="symbol not found in DB")
 
-    return {
+    result = {
         "symbol": doc["symbol"],
         "name": doc.get("name", ""),
         "c": float(doc.get("price", 0.0) or 0.0),
@@ -177,56 +323,101 @@ def quote(symbol: str, uid: str = Depends(require_user)):
         "updatedAt": doc.get("updatedAt"),
         "source": "mongodb"
     }
+    _quote_cache[symbol] = result
+    return result
 
 
 # ============== History & Charts ==============
 
 # Updates the historical data for a stock
 # IMPORTANT: Sorts the points by timestamp to ensure the chart renders correctly
+# Points are stored column-wise (see history_store); a not-yet-migrated
+# "points" list is removed, since the upload replaces the whole history
 @router.post("/stocks/history")
-def upsert_history(body: StockHistoryBody, uid: str = Depends(require_user)):
+async def upsert_history(body: StockHistoryBody, uid: str = Depends(require_user)):
     db = get_db()
     symbol = norm_symbol(body.symbol)
 
-    points = sorted([p.model_dump() for p in body.points], key=lambda x: x["ts"])
+    points = _points_adapter.dump_python(sorted(body.points, key=lambda p: p.ts))
 
-    db["stock_history"].update_one(
+    await db["stock_history"].update_one(
         {"symbol": symbol},
         {"$set": {
             "symbol": symbol,
-            "points": points,
+            **history_store.to_columns(points),
             "updatedAt": int(time.time())
-        }},
+        }, "$inc": {"version": 1}, "$unset": {"points": ""}},
         upsert=True
     )
 
     return {"ok": True, "symbol": symbol, "count": len(points)}
 
+# Number of history points encoded per streamed chunk
+HISTORY_CHUNK_SIZE = 250
+
+# Encodes a history document as {"symbol", "updatedAt", "points": [...]},
+# yielding the points array a chunk at a time
+async def stream_history(symbol: str, doc: dict, limit: int):
+    head = orjson.dumps({"symbol": symbol, "updatedAt": doc.get("updatedAt")})
+    yield head[:-1] + b',"points":['
+
+    points = history_store.iter_points(doc, limit)
+    first = True
+    while chunk := list(islice(points, HISTORY_CHUNK_SIZE)):
+        yield (b"" if first else b",") + orjson.dumps(chunk)[1:-1]
+        first = False
+
+    yield b"]}"
+
 # Retrieves historical points for charting
-# Returns points sorted chronologically
+# Points are stored sorted by timestamp and rebuilt from the stored columns
+# Only the latest 'limit' points are fetched ('$slice' runs inside MongoDB)
+# Supports conditional GET via an ETag derived from the history version; when the
+# client sends If-None-Match, only the version is read before answering 304
+# The JSON body is streamed in chunks instead of being encoded in one piece
 @router.get("/stocks/{symbol}/history")
-def get_history(symbol: str, uid: str = Depends(require_user)):
+async def get_history(
+    request: Request,
+    symbol: str,
+    limit: int = Query(2000, ge=1),
+    uid: str = Depends(require_user)
+):
     db = get_db()
     symbol = norm_symbol(symbol)
+    history = db["stock_history"]
+
+    if request.headers.get("if-none-match"):
+        meta = await history.find_one({"symbol": symbol}, {"_id": 0, "version": 1})
+        if meta:
+            etag = make_etag(symbol, meta.get("version", 0), limit)
+            if etag_matches(request, etag):
+                return Response(status_code=304, headers={"ETag": etag})
 
-    doc = db["stock_history"].find_one({"symbol": symbol}, {"_id": 0})
+    doc = await history.find_one(
+        {"symbol": symbol},
+        history_store.tail_projection(limit)
+    )
     if not doc:
         return {"symbol": symbol, "points": []}
 
-    pts = sorted(doc.get("points", []), key=lambda x: x.get("ts", 0))
-    return {"symbol": symbol, "points": pts, "updatedAt": doc.get("updatedAt")}
+    etag = make_etag(symbol, doc.get("version", 0), limit)
+    return StreamingResponse(
+        stream_history(symbol, doc, limit),
+        media_type="application/json",
+        headers={"ETag": etag}
+    )
 
 # Appends a single historical data point to an existing stock's history
-@router.post("/stocks/{symbol}/history/append")
-def append_history_point(symbol: str, point: HistoryPoint, uid: str = Depends(require_user)):
-    db = get_db()
+# The point is queued and written in a batch by the history buffer, so the
+# write is eventually consistent: 202 Accepted is returned before it is stored
+# (normally within ~50ms); 503 if the buffer is full
+# Late or out-of-order points are merged in timestamp order
+@router.post("/stocks/{symbol}/history/append", status_code=202)
+async def append_history_point(symbol: str, point: HistoryPoint, uid: str = Depends(require_user)):
     symbol = norm_symbol(symbol)
 
-    db["stock_history"].update_one(
-        {"symbol": symbol},
-        {"$push": {"points": point.model_dump()}, "$set": {"updatedAt": int(time.time())}},
-        upsert=True
-    )
+    if not history_buffer.queue_point(symbol, point.model_dump()):
+        raise HTTPException(status_code=503, detail="history buffer full, retry later")
     return {"ok": True, "symbol": symbol}
 
 
@@ -235,19 +426,19 @@ def append_history_point(symbol: str, point: HistoryPoint, uid: str = Depends(re
 
 # Retrieves the list of tracked stocks for the current user
 @router.get("/watchlist")
-def get_watchlist(uid: str = Depends(require_user)):
+async def get_watchlist(uid: str = Depends(require_user)):
     db = get_db()
-    wl = db["watchlists"].find_one({"userId": uid}) or {"symbols": []}
+    wl = await db["watchlists"].find_one({"userId": uid}) or {"symbols": []}
     return {"symbols": wl.get("symbols", [])}
 
 # Adds a stock to the user's watchlist
 # Uses '$addToSet' to prevent duplicate entries
 @router.post("/watchlist")
-def add_watch(body: WatchBody, uid: str = Depends(require_user)):
+async def add_watch(body: WatchBody, uid: str = Depends(require_user)):
     symbol = norm_symbol(body.symbol)
 
     db = get_db()
-    db["watchlists"].update_one(
+    await db["watchlists"].update_one(
         {"userId": uid},
         {"$addToSet": {"symbols": symbol}},
         upsert=True
@@ -256,11 +447,11 @@ def add_watch(body: WatchBody, uid: str = Depends(require_user)):
 
 # Removes a stock from the user's watchlist
 @router.delete("/watchlist/{symbol}")
-def remove_watch(symbol: str, uid: str = Depends(require_user)):
+async def remove_watch(symbol: str, uid: str = Depends(require_user)):
     db = get_db()
     symbol = norm_symbol(symbol)
 
-    db["watchlists"].update_one(
+    await db["watchlists"].update_one(
         {"userId": uid},
         {"$pull": {"symbols": symbol}},
         upsert=True
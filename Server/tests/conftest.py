@@ -0,0 +1,4 @@
+import os
+
+# src.db requires a connection string at import time; tests never connect
+os.environ.setdefault("MONGO_URI", "mongodb://localhost:27017")
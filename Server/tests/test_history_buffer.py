@@ -0,0 +1,98 @@
+import asyncio
+import bson
+import pytest
+from pymongo.errors import AutoReconnect, BulkWriteError
+from src import history_buffer
+
+
+# Stands in for the stock_history collection
+# BSON-encodes every op like the driver would, then fails or succeeds as told
+class FakeCollection:
+    def __init__(self, error=None):
+        self.error = error
+        self.written = []
+
+    async def bulk_write(self, ops, ordered=True):
+        for op in ops:
+            bson.encode({"q": op._filter, "u": op._doc})
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+        self.written.extend(op._filter["symbol"] for op in ops)
+
+
+@pytest.fixture
+def collection(monkeypatch):
+    monkeypatch.setattr(history_buffer, "_pending", {})
+    monkeypatch.setattr(history_buffer, "_pending_count", 0)
+    monkeypatch.setattr(history_buffer, "_attempts", {})
+    coll = FakeCollection()
+    monkeypatch.setattr(history_buffer, "get_db", lambda: {"stock_history": coll})
+    return coll
+
+
+def point(ts=1700000000, price=1.5, volume=10):
+    return {"ts": ts, "price": price, "volume": volume}
+
+
+def test_connection_error_requeues_the_batch(collection):
+    collection.error = AutoReconnect("connection lost")
+    history_buffer.queue_point("AAPL", point())
+    history_buffer.queue_point("MSFT", point())
+
+    assert asyncio.run(history_buffer.flush()) == 2
+    assert history_buffer._pending_count == 2
+
+    assert asyncio.run(history_buffer.flush()) == 0
+    assert sorted(collection.written) == ["AAPL", "MSFT"]
+    assert history_buffer._pending_count == 0
+
+
+def test_partial_bulk_write_error_retries_only_transient_failures(collection):
+    collection.error = BulkWriteError({"writeErrors": [
+        {"index": 1, "code": 11000, "errmsg": "duplicate key"},
+        {"index": 2, "code": 10334, "errmsg": "document too large"}
+    ]})
+    for symbol in ("AAPL", "MSFT", "NKE"):
+        history_buffer.queue_point(symbol, point())
+
+    assert asyncio.run(history_buffer.flush()) == 1
+    assert list(history_buffer._pending) == ["MSFT"]
+
+
+def test_unencodable_point_is_dropped_without_losing_the_others(collection):
+    history_buffer.queue_point("BAD", point(price=float("nan")))
+    history_buffer.queue_point("BAD", point(price=1e20))
+    history_buffer.queue_point("AAPL", point())
+
+    assert asyncio.run(history_buffer.flush()) == 0
+    assert collection.written == ["AAPL"]
+    assert history_buffer._pending_count == 0
+
+
+def test_retries_are_capped(collection, monkeypatch):
+    monkeypatch.setattr(history_buffer, "MAX_RETRIES", 2)
+    history_buffer.queue_point("AAPL", point())
+
+    for _ in range(2):
+        collection.error = AutoReconnect("connection lost")
+        assert asyncio.run(history_buffer.flush()) == 1
+
+    collection.error = AutoReconnect("connection lost")
+    assert asyncio.run(history_buffer.flush()) == 0
+    assert history_buffer._pending_count == 0
+
+
+def test_buffer_flushes_again_after_a_restart(collection, monkeypatch):
+    monkeypatch.setattr(history_buffer, "FLUSH_INTERVAL", 0.01)
+
+    async def cycle(symbol):
+        history_buffer.start()
+        history_buffer.queue_point(symbol, point())
+        await asyncio.sleep(0.1)
+        written = list(collection.written)
+        await history_buffer.stop()
+        return written
+
+    assert asyncio.run(cycle("AAPL")) == ["AAPL"]
+    assert asyncio.run(cycle("MSFT")) == ["AAPL", "MSFT"]
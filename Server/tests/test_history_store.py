@@ -0,0 +1,114 @@
+import asyncio
+import copy
+from types import SimpleNamespace
+from src import history_store
+
+
+def test_round_trip_keeps_timestamps_volumes_and_prices():
+    points = [
+        {"ts": 1700000000, "price": 189.12, "volume": 1200},
+        {"ts": 1700000060, "price": 1.005, "volume": 0},
+        {"ts": 1700000120, "price": 0.0042, "volume": 3_000_000_000},
+        {"ts": 1700000180, "price": 612543.25, "volume": 7}
+    ]
+
+    decoded = list(history_store.iter_points(history_store.to_columns(points)))
+
+    assert decoded == points
+    assert history_store.round_trips(points)
+
+
+def test_columns_are_offsets_from_the_first_timestamp():
+    points = [
+        {"ts": 1700000000, "price": 1.5, "volume": 1},
+        {"ts": 1700000060, "price": 2.5, "volume": 2}
+    ]
+
+    columns = history_store.to_columns(points)
+
+    assert columns["base_ts"] == 1700000000
+    assert columns["ts_delta"] == [0, 60]
+    assert columns["price_units"] == [1_500_000, 2_500_000]
+
+
+def test_empty_points_keep_the_stored_base():
+    assert "base_ts" not in history_store.to_columns([])
+    assert list(history_store.iter_points({})) == []
+
+
+# Minimal in-memory stand-in for the stock_history collection, supporting what
+# migrate_legacy uses: find on "points" existing, and UpdateOne with $set/$rename
+# filtered on _id, field existence and version
+class FakeCollection:
+    def __init__(self, docs, before_write=None):
+        self.docs = {doc["_id"]: doc for doc in docs}
+        self.before_write = before_write
+
+    async def find(self, query):
+        for doc in list(self.docs.values()):
+            if "points" in doc:
+                yield copy.deepcopy(doc)
+
+    def _matches(self, doc, flt):
+        for key, cond in flt.items():
+            if isinstance(cond, dict) and "$exists" in cond:
+                if (key in doc) != cond["$exists"]:
+                    return False
+            elif doc.get(key) != cond:
+                return False
+        return True
+
+    async def bulk_write(self, ops, ordered=True):
+        if self.before_write:
+            self.before_write(self)
+        matched = 0
+        for op in ops:
+            doc = next((d for d in self.docs.values() if self._matches(d, op._filter)), None)
+            if doc is None:
+                continue
+            matched += 1
+            doc.update(op._doc.get("$set", {}))
+            for old, new in op._doc.get("$rename", {}).items():
+                doc[new] = doc.pop(old)
+        return SimpleNamespace(matched_count=matched)
+
+
+LEGACY_POINTS = [
+    {"ts": 1700000060, "price": 2.0, "volume": 2},
+    {"ts": 1700000000, "price": 1.0, "volume": 1}
+]
+
+
+def test_migration_keeps_points_appended_before_it_ran():
+    # Legacy document that already received a buffered append after the upgrade
+    appended = history_store.to_columns([{"ts": 1700000120, "price": 3.0, "volume": 3}])
+    doc = {"_id": 1, "symbol": "AAPL", "points": list(LEGACY_POINTS), **appended, "version": 1}
+    collection = FakeCollection([doc])
+
+    assert asyncio.run(history_store.migrate_legacy(collection)) == (1, 0, 0)
+
+    migrated = collection.docs[1]
+    assert "points" not in migrated
+    assert migrated["legacy_points"] == LEGACY_POINTS
+    assert migrated["version"] == 2
+    assert [p["ts"] for p in history_store.iter_points(migrated)] == [1700000000, 1700000060, 1700000120]
+
+
+def test_migration_skips_documents_written_while_converting():
+    def concurrent_append(collection):
+        collection.docs[1]["version"] = 5
+
+    doc = {"_id": 1, "symbol": "AAPL", "points": list(LEGACY_POINTS)}
+    collection = FakeCollection([doc], before_write=concurrent_append)
+
+    assert asyncio.run(history_store.migrate_legacy(collection)) == (0, 0, 1)
+    assert collection.docs[1]["points"] == LEGACY_POINTS
+
+
+def test_unmigrated_documents_are_read_merged_with_new_columns():
+    appended = history_store.to_columns([{"ts": 1700000120, "price": 3.0, "volume": 3}])
+    doc = {"points": list(LEGACY_POINTS), **appended}
+
+    points = list(history_store.iter_points(doc, limit=2))
+
+    assert [p["ts"] for p in points] == [1700000060, 1700000120]